@@ -15,6 +15,7 @@ setup(
         "websockets>=10.0",
         "tifffile>=2023.3.15",
         "opencv-python>=4.5.0",
+        "diskcache>=5.0.0",
         "python-multipart>=0.0.5"
     ],
     entry_points={
@@ -1,62 +1,195 @@
 import pyvips
+import io
 import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-def custom_dzsave(original_image_path: str, output_name: str, downsize_factor: int = 3):
+import openslide
+from openslide.deepzoom import DeepZoomGenerator
+
+# 瓦片 JPEG 编码参数：Q=80 + 哈夫曼表优化 + 渐进式；链接 mozjpeg 时启用 trellis 量化
+JPEG_SUFFIX = ".jpg[Q=80,optimize_coding=true,strip=true,interlace=true,trellis_quant=true,overshoot_deringing=true]"
+
+def drop_page_cache(output_name: str):
+    """
+    释放 DZI 输出文件占用的页缓存，避免大量只读一次的瓦片挤出源切片的热数据
+
+    DONTNEED 不会丢弃脏页，因此分两遍处理：第一遍对所有文件 posix_fadvise(DONTNEED)，
+    丢弃已落盘的页并让内核对脏页发起异步回写；第二遍再逐个 fdatasync（此时大部分已写完）
+    后 DONTNEED。只处理本次输出，不做全局 sync。
+
+    :param output_name: 输出 DZI 名称（同时处理 .zip/.dzi 文件和 _files 目录）
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    paths = [Path(f"{output_name}{ext}") for ext in (".zip", ".szi", ".dzi")]
+    paths = [p for p in paths if p.is_file()]
+    for root, _, files in os.walk(f"{output_name}_files"):
+        paths.extend(Path(root) / f for f in files)
+    if not paths:
+        return
+
+    for flush in (False, True):
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if flush:
+                    os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def deepzoom_dzsave(slide_path: str, output_name: str, tile_size: int = 256,
+                    container: str = "zip"):
+    """
+    利用 openslide 中已存储的多分辨率金字塔生成 DZI 文件（每层 2 倍下采样）
+
+    每个瓦片直接从最接近的原生层级读取，无需对整幅图像逐层 resize。
+
+    :param slide_path: WSI 文件路径（.svs/.ndpi/.mrxs 等）
+    :param output_name: 输出 DZI 名称
+    :param tile_size: 瓦片大小
+    :param container: "zip" 写入单个 {output_name}.zip（与 dzsave 的 zip 布局一致），"fs" 写入目录
+    """
+    name = Path(output_name).name
+    out_dir = Path(output_name).parent
+
+    slide = openslide.OpenSlide(slide_path)
+    zf = zipfile.ZipFile(f"{output_name}.zip", "w", zipfile.ZIP_STORED) if container == "zip" else None
+    try:
+        dz = DeepZoomGenerator(slide, tile_size=tile_size, overlap=0)
+
+        def write_file(arcname: str, data: bytes):
+            if zf is not None:
+                zf.writestr(f"{name}/{arcname}", data)
+            else:
+                path = out_dir / arcname
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+
+        # openslide 读取与 JPEG 编码都会释放 GIL，用线程池并行编码同一层级的瓦片，
+        # 写出统一在当前线程完成（ZipFile 不支持并发写入）
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for level in range(dz.level_count):
+                def encode_tile(address, level=level):
+                    buf = io.BytesIO()
+                    dz.get_tile(level, address).save(
+                        buf, "JPEG", quality=80, optimize=True, progressive=True)
+                    return address, buf.getvalue()
+
+                cols, rows = dz.level_tiles[level]
+                addresses = ((col, row) for row in range(rows) for col in range(cols))
+                for (col, row), data in executor.map(encode_tile, addresses):
+                    write_file(f"{name}_files/{level}/{col}_{row}.jpg", data)
+
+        write_file(f"{name}.dzi", dz.get_dzi("jpg").encode())
+    finally:
+        if zf is not None:
+            zf.close()
+        slide.close()
+
+def _custom_factor_dzsave(original_image_path: str, output_name: str,
+                          downsize_factor: int, tile_size: int, container: str):
+    """
+    生成 downsize_factor 倍下采样的金字塔，布局与 dzsave 一致：
+    {name}_files/{level}/{col}_{row}.jpg，level 越大分辨率越高，最高层为原图
+
+    每层重新以顺序访问打开原图并直接缩放 1/factor^k，用 dzsave(depth="one") 只切该层瓦片，
+    再移入同一个 _files 目录（或写入同一个 zip）。
+    """
+    name = Path(output_name).name
+    out_dir = Path(output_name).parent
+
+    # 计算层数（直到宽高都不超过瓦片大小）
+    image = pyvips.Image.new_from_file(original_image_path, access="sequential")
+    width, height = image.width, image.height
+    level_count = 1
+    while max(width, height) / downsize_factor ** (level_count - 1) > tile_size:
+        level_count += 1
+
+    zf = zipfile.ZipFile(f"{output_name}.zip", "w", zipfile.ZIP_STORED) if container == "zip" else None
+    try:
+        with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+            for k in range(level_count):
+                level = level_count - 1 - k
+                level_image = pyvips.Image.new_from_file(original_image_path, access="sequential")
+                if k > 0:
+                    level_image = level_image.resize(1 / downsize_factor ** k)
+                level_image.dzsave(f"{tmp_dir}/{level}", tile_size=tile_size, overlap=0,
+                                   suffix=JPEG_SUFFIX, depth="one")
+
+                tiles_dir = Path(tmp_dir) / f"{level}_files" / "0"
+                for tile in os.scandir(tiles_dir):
+                    arcname = f"{name}_files/{level}/{tile.name}"
+                    if zf is not None:
+                        zf.write(tile.path, f"{name}/{arcname}")
+                    else:
+                        path = out_dir / arcname
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        shutil.move(tile.path, path)
+                shutil.rmtree(Path(tmp_dir) / f"{level}_files")
+
+        dzi_xml = (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                   f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpg" '
+                   f'Overlap="0" TileSize="{tile_size}">\n'
+                   f'  <Size Width="{width}" Height="{height}"/>\n'
+                   f'</Image>\n')
+        if zf is not None:
+            zf.writestr(f"{name}/{name}.dzi", dzi_xml)
+        else:
+            (out_dir / f"{name}.dzi").write_text(dzi_xml)
+    finally:
+        if zf is not None:
+            zf.close()
+
+def custom_dzsave(original_image_path: str, output_name: str, downsize_factor: int = 3,
+                  container: str = "zip"):
     """
-    手动生成自定义下采样倍数的 DZI 文件
+    生成自定义下采样倍数的 DZI 文件
+
+    2 倍下采样时由 libvips 原生 dzsave 在同一条流水线中生成所有层级的瓦片和 .dzi 描述文件；
+    dzsave 不支持其他倍数，此时逐层缩放并切片（见 _custom_factor_dzsave）。
     
     :param original_image_path: 原始图像路径
     :param output_name: 输出 DZI 名称
     :param downsize_factor: 下采样倍数（如 3）
+    :param container: "zip" 将全部瓦片写入单个 {output_name}.zip，"fs" 写入目录树
     """
-    # 读取原始图像（level 0）
-    image = pyvips.Image.new_from_file(original_image_path)
-    levels = []
-    current_image = image
-    level = 0
+    # openslide 可识别的 WSI 且为 2 倍下采样时，直接使用其原生金字塔
+    if downsize_factor == 2 and openslide.OpenSlide.detect_format(original_image_path):
+        deepzoom_dzsave(original_image_path, output_name, container=container)
+        drop_page_cache(output_name)
+        print(f"自定义 DZI 生成完成：{output_name}")
+        return
 
-    # 生成各层级图像（直到尺寸小于等于瓦片大小）
     tile_size = 256
-    while True:
-        width, height = current_image.width, current_image.height
-        levels.append((level, width, height, current_image))
-        
-        # 下采样生成下一层级（使用 pyvips 的 resize 方法）
-        next_width = max(1, width // downsize_factor)
-        next_height = max(1, height // downsize_factor)
-        if next_width <= tile_size and next_height <= tile_size:
-            break  # 停止生成层级
-        
-        # 下采样（使用双线性插值）
-        current_image = current_image.resize(1 / downsize_factor, kernel="linear")
-        level += 1
-
-    # 创建 DZI 目录和瓦片文件
-    dzi_dir = Path(f"{output_name}_files")
-    dzi_dir.mkdir(exist_ok=True)
-    for level, width, height, img in levels:
-        level_dir = dzi_dir / str(level)
-        level_dir.mkdir(exist_ok=True)
-        
-        # 切割瓦片（使用 pyvips 的 dzsave 逻辑或手动切割）
-        img.dzsave(
-            str(level_dir / "tile"),  # 瓦片文件前缀
+    if downsize_factor == 2:
+        # 读取原始图像（level 0），顺序访问以启用 libvips 的流式读取
+        image = pyvips.Image.new_from_file(original_image_path, access="sequential")
+
+        # 一次性生成金字塔（瓦片 + DZI XML 均由 dzsave 写出；zip 容器下只产生一个文件，
+        # JPEG 已压缩，故 compression=0 直接存储）
+        image.dzsave(
+            output_name,
             tile_size=tile_size,
             overlap=0,
-            suffix=".jpg"
+            suffix=JPEG_SUFFIX,
+            depth="onepixel",
+            container=container,
+            compression=0
         )
+    else:
+        # dzsave 只支持 2 倍下采样（没有 downsize 参数），其他倍数逐层缩放后单独切片
+        _custom_factor_dzsave(original_image_path, output_name, downsize_factor,
+                              tile_size, container)
+    drop_page_cache(output_name)
 
-    # 生成 DZI XML 文件
-    dzi_xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<Image Format="jpg" Overlap="0" TileSize="{tile_size}" xmlns="http://schemas.microsoft.com/deepzoom/2008">
-  {"".join([f'  <Size Width="{w}" Height="{h}"/>' for _, w, h, _ in levels])}
-</Image>
-"""
-    with open(f"{output_name}.dzi", "w") as f:
-        f.write(dzi_xml)
-
-    print(f"自定义 DZI 生成完成：{output_name}.dzi")
+    print(f"自定义 DZI 生成完成：{output_name}")
 
 # 示例用法（下采样倍数 3）
 custom_dzsave("large_image.tif", "custom_dzi", downsize_factor=3)
\ No newline at end of file
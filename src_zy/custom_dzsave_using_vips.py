@@ -1,23 +1,30 @@
-import subprocess
+import asyncio
+import os
 
-def vips_cli_dzsave(input_path: str, output_name: str, downsize: int = 3):
+async def vips_cli_dzsave(input_path: str, output_name: str):
     """
-    通过 libvips 命令行调用 dzsave，支持 --downsize 参数
+    通过 libvips 命令行调用 dzsave（DeepZoom 固定 2 倍下采样，dzsave 没有 --downsize 参数；
+    自定义倍数见 custom_dzsave_using_pyvips.custom_dzsave）
+
+    以异步子进程运行，可在事件循环中调用而不阻塞其他请求；
+    进度输出到 stdout，stderr 被收集用于失败时报错。
     """
     cmd = [
         "vips",
         "dzsave",
         input_path,
         output_name,
-        f"--downsize={downsize}",
         "--tile-size=256",
-        "--suffix=.jpg"
+        "--suffix=.jpg[Q=80,optimize_coding=true,strip=true]",
+        f"--vips-concurrency={os.cpu_count() or 1}",
+        "--vips-progress"
     ]
-    try:
-        subprocess.run(cmd, check=True)
-        print(f"通过命令行生成 DZI 成功：{output_name}.dzi")
-    except subprocess.CalledProcessError as e:
-        print(f"命令行调用失败：{e}")
+    proc = await asyncio.create_subprocess_exec(*cmd, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"命令行调用失败（返回码 {proc.returncode}）：{stderr.decode(errors='replace')}")
+    print(f"通过命令行生成 DZI 成功：{output_name}.dzi")
 
 # 示例用法
-vips_cli_dzsave("large_image.tif", "cli_dzi", downsize=3)
\ No newline at end of file
+asyncio.run(vips_cli_dzsave("large_image.tif", "cli_dzi"))
\ No newline at end of file
@@ -5,7 +5,7 @@ from pathlib import Path
 def generate_dzi_image(slide_path, outpath=None):
     slide_id = Path(slide_path).stem
     # Load the slide
-    image = pyvips.Image.new_from_file(slide_path)
+    image = pyvips.Image.new_from_file(slide_path, access="sequential")
 
     # Generate the DZI image
     outpath = outpath or slide_id
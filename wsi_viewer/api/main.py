@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import logging.handlers
 import os
@@ -6,6 +7,12 @@ import sys
 import traceback
 from pathlib import Path
 
+# libvips 线程数只用一半核数，其余留给 asyncio/线程池，避免与 FastAPI 线程池叠加过载。
+# pyvips < 3.0 没有 concurrency_set，需在导入 pyvips（初始化 libvips）前通过环境变量设置
+VIPS_CONCURRENCY = max(1, (os.cpu_count() or 4) // 2)
+os.environ.setdefault("VIPS_CONCURRENCY", str(VIPS_CONCURRENCY))
+
+import pyvips
 from fastapi import (FastAPI, File, HTTPException, Query, UploadFile,
                      WebSocket, WebSocketDisconnect)
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,8 +23,8 @@ from .routers import wsi
 from .services.wsi_service import WSIService
 
 
-def setup_logging():
-    """配置日志系统"""
+def setup_runtime():
+    """配置日志系统及 libvips 运行参数"""
     log_dir = Path(__file__).parent.parent / "logs"
     log_dir.mkdir(parents=True, exist_ok=True)
     
@@ -49,8 +56,14 @@ def setup_logging():
     logging.getLogger("uvicorn").setLevel(logging.WARNING)
     logging.getLogger("fastapi").setLevel(logging.WARNING)
 
-# 初始化日志
-setup_logging()
+    # 配置 libvips：放大操作缓存，使热点切片的解码流水线在多次tile请求间保持缓存
+    pyvips.cache_set_max(1000)
+    pyvips.cache_set_max_mem(512 * 1024 * 1024)
+    if hasattr(pyvips, "concurrency_set"):
+        pyvips.concurrency_set(int(os.environ["VIPS_CONCURRENCY"]))
+
+# 初始化日志及运行参数
+setup_runtime()
 logger = logging.getLogger(__name__)
 
 # 创建FastAPI应用
@@ -81,6 +94,19 @@ app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 # 注册路由
 app.include_router(wsi.router, prefix="/api/slides", tags=["slides"])
 
+@app.on_event("startup")
+async def init_services():
+    """初始化路由共享的WSI服务和tile缓存（每个进程只创建一次）"""
+    wsi.UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    app.state.wsi_service = WSIService(cache_dir=str(wsi.CACHE_DIR))
+    app.state.tile_cache = wsi.create_tile_cache(wsi.CACHE_DIR)
+
+@app.on_event("shutdown")
+async def close_services():
+    """释放共享资源"""
+    app.state.wsi_service.close()
+    app.state.tile_cache.close()
+
 # WebSocket连接管理
 class ConnectionManager:
     def __init__(self):
@@ -89,20 +115,23 @@ class ConnectionManager:
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
-        logger.info(f"WebSocket连接建立 - 当前连接数: {len(self.active_connections)}")
+        logger.info("WebSocket连接建立 - 当前连接数: %s", len(self.active_connections))
 
     def disconnect(self, websocket: WebSocket):
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
-            logger.info(f"WebSocket连接断开 - 当前连接数: {len(self.active_connections)}")
+            logger.info("WebSocket连接断开 - 当前连接数: %s", len(self.active_connections))
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"发送消息失败: {str(e)}")
-                await self.disconnect(connection)
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(message) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                logger.error("发送消息失败: %s", result)
+                self.disconnect(connection)
 
 manager = ConnectionManager()
 
@@ -115,7 +144,7 @@ async def websocket_endpoint(websocket: WebSocket):
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
-        logger.error(f"WebSocket错误: {str(e)}")
+        logger.error("WebSocket错误: %s", e)
         manager.disconnect(websocket)
 
 @app.get("/")
@@ -123,6 +152,11 @@ async def root():
     """健康检查端点"""
     return {"status": "ok", "message": "WSI Viewer API is running"}
 
+@app.get("/healthz")
+async def healthz():
+    """就绪探针"""
+    return {"ok": True}
+
 def start_server(host="0.0.0.0", port=5000, log_level="info"):
     """启动服务器"""
     # 设置进程启动方法
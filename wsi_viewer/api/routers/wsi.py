@@ -1,46 +1,162 @@
+import asyncio
+import hashlib
 import logging
 import os
-import sys
+import shutil
 import uuid
 from pathlib import Path
 from typing import Optional
 
-from fastapi import APIRouter, File, HTTPException, Query, UploadFile
-from fastapi.responses import FileResponse
+import diskcache
+from fastapi import (APIRouter, Depends, File, HTTPException, Query, Request,
+                     UploadFile)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
 
+from ..services.wsi_reader import sniff_image_header
 from ..services.wsi_service import WSIService
 
 # 创建路由器
 router = APIRouter()
 
-# 配置日志
+# 配置日志（级别与处理器沿用 main.setup_runtime 中的根日志配置）
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-# 添加控制台处理器
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 # 配置WSI文件存储路径
 UPLOAD_DIR = Path("static/slides")
 CACHE_DIR = Path("static/tiles")
 
-# 确保目录存在
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-CACHE_DIR.mkdir(parents=True, exist_ok=True)
+# 上传文件分块写入大小（4MB）
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 上传时用于识别文件格式的文件头大小
+UPLOAD_SNIFF_SIZE = 8192
+
+# slide_id 是上传时的文件名，删除后可以用同名上传另一张切片，tile URL 并非内容寻址，
+# 因此只短期缓存，过期后凭 ETag（含切片文件的修改时间和大小）重新验证
+TILE_CACHE_CONTROL = "public, max-age=600"
+
+# 同时生成tile的最大并发数，与CPU核数一致，避免线程池过载
+TILE_CONCURRENCY = os.cpu_count() or 4
+
+# 限制tile生成并发
+_tile_sem = asyncio.Semaphore(TILE_CONCURRENCY)
+
+# 正在生成的tile，键与tile缓存相同（见 _tile_key），值为生成任务
+_inflight_tiles: dict = {}
+
+
+def create_tile_cache(cache_dir: Path = CACHE_DIR) -> diskcache.FanoutCache:
+    """创建tile字节缓存，键见 _tile_key，以 slide_id 作为 tag"""
+    return diskcache.FanoutCache(
+        str(cache_dir / "fanout"),
+        shards=8,
+        size_limit=50 * 2**30,
+        eviction_policy="least-recently-used",
+        tag_index=True
+    )
+
+
+async def get_wsi_service(request: Request) -> WSIService:
+    """获取应用启动时创建的共享WSI服务"""
+    return request.app.state.wsi_service
+
+
+async def get_tile_cache(request: Request) -> diskcache.FanoutCache:
+    """获取应用启动时创建的共享tile缓存"""
+    return request.app.state.tile_cache
+
+
+def _tile_etag(slide_id: str, slide_stat: os.stat_result, level: int, x: int,
+               y: int, size: int) -> str:
+    """根据切片文件身份（修改时间、大小）和tile键生成强ETag"""
+    digest = hashlib.blake2b(
+        f"{slide_id}|{slide_stat.st_mtime_ns}|{slide_stat.st_size}|"
+        f"{level}|{x}|{y}|{size}".encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def _tile_key(slide_id: str, slide_stat: os.stat_result, level: int, x: int,
+              y: int, size: int) -> tuple:
+    """tile缓存键，包含切片文件身份，切片被删除或替换后旧的写入不会再被命中"""
+    return (slide_id, slide_stat.st_mtime_ns, slide_stat.st_size,
+            level, x, y, size)
+
+
+async def _generate_tile(wsi_service: WSIService, slide_path: Path, x: int,
+                         y: int, level: int, size: int) -> Optional[bytes]:
+    """在线程池中生成并读取tile（避免阻塞事件循环）"""
+    async with _tile_sem:
+        return await run_in_threadpool(
+            wsi_service.read_tile, str(slide_path), x, y, level, size)
+
+
+async def _produce_tile(wsi_service: WSIService,
+                        tile_cache: diskcache.FanoutCache, key: tuple,
+                        slide_path: Path, x: int, y: int, level: int,
+                        size: int) -> Optional[bytes]:
+    """生成tile，写入tile缓存并预取相邻tile（每个tile只执行一次）"""
+    data = await _generate_tile(wsi_service, slide_path, x, y, level, size)
+    if data is not None:
+        tile_cache.set(key, data, expire=None, tag=key[0])
+        # 键的前三项 (slide_id, st_mtime_ns, st_size) 为切片文件身份
+        _prefetch_neighbors(wsi_service, tile_cache, key[:3], slide_path,
+                            x, y, level, size)
+    return data
+
+
+async def _get_tile_coalesced(wsi_service: WSIService,
+                              tile_cache: diskcache.FanoutCache, key: tuple,
+                              slide_path: Path, x: int, y: int, level: int,
+                              size: int) -> Optional[bytes]:
+    """合并相同tile的并发请求，只有第一个请求真正执行生成"""
+    task = _inflight_tiles.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_produce_tile(
+            wsi_service, tile_cache, key, slide_path, x, y, level, size))
+        _inflight_tiles[key] = task
+        task.add_done_callback(lambda _: _inflight_tiles.pop(key, None))
+    # shield: 某个客户端断开时不取消其他请求共享的任务
+    return await asyncio.shield(task)
+
 
-# 初始化WSI服务
-wsi_service = WSIService(cache_dir=str(CACHE_DIR))
+def _prefetch_neighbors(wsi_service: WSIService,
+                        tile_cache: diskcache.FanoutCache, slide_key: tuple,
+                        slide_path: Path, x: int, y: int, level: int, size: int):
+    """在后台预取相邻tile并写入tile缓存，平移/缩放时的下一批请求可直接命中
+
+    slide_key 为 (slide_id, st_mtime_ns, st_size)，与tile坐标拼成缓存键。
+    """
+    def is_cached(tile):
+        nx, ny, nlevel, nsize = tile
+        return slide_key + (nlevel, nx, ny, nsize) in tile_cache
+
+    def on_tile(tile, data):
+        nx, ny, nlevel, nsize = tile
+        tile_cache.set(slide_key + (nlevel, nx, ny, nsize), data,
+                       expire=None, tag=slide_key[0])
+
+    wsi_service.prefetch_neighbors(str(slide_path), x, y, level, size,
+                                   is_cached=is_cached, on_tile=on_tile)
+
+
+def _save_upload(file: UploadFile, slide_path: Path, head: bytes = b""):
+    """将上传文件分块复制到磁盘，避免整个文件读入内存
+
+    head 为已读取用于格式识别的文件头，先写入后再复制剩余内容。
+    """
+    with open(slide_path, "wb") as buffer:
+        buffer.write(head)
+        shutil.copyfileobj(file.file, buffer, length=UPLOAD_CHUNK_SIZE)
 
 
 @router.post("/upload")
-async def upload_slide(file: UploadFile = File(...)):
+async def upload_slide(
+    file: UploadFile = File(...),
+    wsi_service: WSIService = Depends(get_wsi_service)
+):
     """上传WSI切片文件"""
-    logger.debug(f"开始处理文件上传: {file.filename}")
+    logger.debug("开始处理文件上传: %s", file.filename)
 
     try:
         # 生成唯一文件名
@@ -51,23 +167,30 @@ async def upload_slide(file: UploadFile = File(...)):
 
         slide_path = UPLOAD_DIR / unique_filename
 
-        logger.debug(f"保存文件到: {slide_path}")
+        logger.debug("保存文件到: %s", slide_path)
 
         # 保存文件
         if not slide_path.exists():
-            try:
-                content = await file.read()
-                if len(content) == 0:
-                    raise ValueError("文件内容为空")
+            # 只读取文件头识别格式，无效文件在写盘前直接拒绝
+            head = await file.read(UPLOAD_SNIFF_SIZE)
+            if not sniff_image_header(unique_filename, head):
+                logger.error("文件格式与扩展名不符: %s", unique_filename)
+                raise HTTPException(
+                    status_code=415,
+                    detail="不支持的文件格式"
+                )
 
-                with open(slide_path, "wb") as buffer:
-                    buffer.write(content)
+            try:
+                await run_in_threadpool(_save_upload, file, slide_path, head)
 
                 file_size = os.path.getsize(slide_path)
-                logger.info(f"文件已保存: {slide_path} (大小: {file_size} 字节)")
+                if file_size == 0:
+                    raise ValueError("文件内容为空")
+
+                logger.info("文件已保存: %s (大小: %s 字节)", slide_path, file_size)
 
             except Exception as e:
-                logger.error(f"保存文件失败: {str(e)}")
+                logger.error("保存文件失败: %s", e)
                 if slide_path.exists():
                     slide_path.unlink()
                 raise HTTPException(
@@ -75,7 +198,7 @@ async def upload_slide(file: UploadFile = File(...)):
                     detail=f"保存文件失败: {str(e)}"
                 )
         else:
-            logger.warning(f"文件已存在: {slide_path}")
+            logger.warning("文件已存在: %s", slide_path)
 
         # 验证文件
         try:
@@ -90,7 +213,7 @@ async def upload_slide(file: UploadFile = File(...)):
                     detail="无效的图像文件"
                 )
 
-            logger.info(f"图像信息: {info}")
+            logger.info("图像信息: %s", info)
             return {
                 "success": True,
                 "slideId": unique_filename,
@@ -98,7 +221,7 @@ async def upload_slide(file: UploadFile = File(...)):
             }
 
         except Exception as e:
-            logger.error(f"验证文件失败: {str(e)}")
+            logger.error("验证文件失败: %s", e)
             if slide_path.exists():
                 slide_path.unlink()
             raise HTTPException(
@@ -109,7 +232,7 @@ async def upload_slide(file: UploadFile = File(...)):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"上传处理失败: {str(e)}")
+        logger.error("上传处理失败: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"文件上传失败: {str(e)}"
@@ -117,14 +240,17 @@ async def upload_slide(file: UploadFile = File(...)):
 
 
 @router.get("/{slide_id}/info")
-async def get_slide_info(slide_id: str):
+async def get_slide_info(
+    slide_id: str,
+    wsi_service: WSIService = Depends(get_wsi_service)
+):
     """获取WSI切片信息"""
-    logger.debug(f"请求切片信息: {slide_id}")
+    logger.debug("请求切片信息: %s", slide_id)
 
     try:
         slide_path = UPLOAD_DIR / slide_id
         if not slide_path.exists():
-            logger.error(f"切片文件未找到: {slide_path}")
+            logger.error("切片文件未找到: %s", slide_path)
             raise HTTPException(
                 status_code=404,
                 detail="切片文件未找到"
@@ -132,19 +258,19 @@ async def get_slide_info(slide_id: str):
 
         success, info = wsi_service.open_slide(str(slide_path))
         if not success:
-            logger.error(f"无法打开切片文件: {slide_path}")
+            logger.error("无法打开切片文件: %s", slide_path)
             raise HTTPException(
                 status_code=500,
                 detail="无法打开切片文件"
             )
 
-        logger.debug(f"返回切片信息: {info}")
+        logger.debug("返回切片信息: %s", info)
         return info
 
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"获取切片信息失败: {str(e)}")
+        logger.error("获取切片信息失败: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"获取切片信息失败: {str(e)}"
@@ -153,42 +279,63 @@ async def get_slide_info(slide_id: str):
 
 @router.get("/{slide_id}/tile")
 async def get_slide_tile(
+    request: Request,
     slide_id: str,
     x: int = Query(..., description="Tile X坐标"),
     y: int = Query(..., description="Tile Y坐标"),
     level: int = Query(..., description="缩放级别"),
-    size: int = Query(256, description="Tile大小")
+    size: int = Query(256, description="Tile大小"),
+    wsi_service: WSIService = Depends(get_wsi_service),
+    tile_cache: diskcache.FanoutCache = Depends(get_tile_cache)
 ):
     """获取WSI切片的指定区域图像"""
-    logger.debug(
-        f"请求tile: slide_id={slide_id}, x={x}, y={y}, level={level}, size={size}")
+    logger.debug("请求tile: slide_id=%s, x=%d, y=%d, level=%d, size=%d",
+                 slide_id, x, y, level, size)
 
     try:
         slide_path = UPLOAD_DIR / slide_id
-        if not slide_path.exists():
-            logger.error(f"切片文件未找到: {slide_path}")
+        try:
+            slide_stat = slide_path.stat()
+        except FileNotFoundError:
+            logger.error("切片文件未找到: %s", slide_path)
             raise HTTPException(
                 status_code=404,
                 detail="切片文件未找到"
             )
 
+        # 浏览器已缓存该tile时直接返回304
+        etag = _tile_etag(slide_id, slide_stat, level, x, y, size)
+        headers = {"Cache-Control": TILE_CACHE_CONTROL, "ETag": etag}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        # 检查tile缓存
+        key = _tile_key(slide_id, slide_stat, level, x, y, size)
+        data = tile_cache.get(key)
+        if data is not None:
+            logger.debug("命中tile缓存: %s", key)
+            return Response(content=data, media_type="image/jpeg",
+                            headers=headers)
+
         # 获取tile
-        tile_path = wsi_service.get_tile(str(slide_path), x, y, level, size)
+        data = await _get_tile_coalesced(
+            wsi_service, tile_cache, key, slide_path, x, y, level, size)
 
-        if tile_path is None:
-            logger.error(f"无法获取tile: x={x}, y={y}, level={level}")
+        if data is None:
+            logger.error("无法获取tile: x=%d, y=%d, level=%d", x, y, level)
             raise HTTPException(
                 status_code=404,
                 detail="无法获取请求的tile"
             )
 
-        logger.debug(f"返回tile: {tile_path}")
-        return FileResponse(tile_path)
+        logger.debug("返回tile: %s (%d 字节)", key, len(data))
+        return Response(content=data, media_type="image/jpeg",
+                        headers=headers)
 
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"获取tile失败: {str(e)}")
+        logger.error("获取tile失败: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"获取tile失败: {str(e)}"
@@ -196,38 +343,42 @@ async def get_slide_tile(
 
 
 @router.delete("/{slide_id}")
-async def delete_slide(slide_id: str):
+async def delete_slide(
+    slide_id: str,
+    wsi_service: WSIService = Depends(get_wsi_service),
+    tile_cache: diskcache.FanoutCache = Depends(get_tile_cache)
+):
     """删除WSI切片文件"""
-    logger.debug(f"请求删除切片: {slide_id}")
+    logger.debug("请求删除切片: %s", slide_id)
 
     try:
         slide_path = UPLOAD_DIR / slide_id
         if not slide_path.exists():
-            logger.error(f"切片文件未找到: {slide_path}")
+            logger.error("切片文件未找到: %s", slide_path)
             raise HTTPException(
                 status_code=404,
                 detail="切片文件未找到"
             )
 
         # 删除原始文件
+        wsi_service.close_slide(str(slide_path))
         slide_path.unlink()
-        logger.info(f"已删除切片文件: {slide_path}")
+        logger.info("已删除切片文件: %s", slide_path)
 
         # 清理相关的缓存文件
         try:
-            cache_pattern = f"{Path(slide_id).stem}_*"
-            for cache_file in CACHE_DIR.glob(cache_pattern):
-                cache_file.unlink()
-                logger.debug(f"已删除缓存文件: {cache_file}")
+            tile_cache.evict(slide_id)
+            shutil.rmtree(CACHE_DIR / slide_id, ignore_errors=True)
+            logger.debug("已删除缓存目录: %s", CACHE_DIR / slide_id)
         except Exception as e:
-            logger.warning(f"清理缓存文件失败: {str(e)}")
+            logger.warning("清理缓存文件失败: %s", e)
 
         return {"success": True, "message": "文件已删除"}
 
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"删除文件失败: {str(e)}")
+        logger.error("删除文件失败: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"删除文件失败: {str(e)}"
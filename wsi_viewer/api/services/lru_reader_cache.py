@@ -1,4 +1,6 @@
+import threading
 from collections import OrderedDict
+from concurrent.futures import Future
 from .wsi_reader import open_slide
 import logging
 
@@ -6,42 +8,84 @@ logger = logging.getLogger(__name__)
 
 
 class LRUReaderCache:
-    """LRU策略的Reader对象缓存（最大容量5）"""
+    """LRU策略的Reader对象缓存（最大容量5，线程安全）"""
 
-    def __init__(self, max_size=5):
+    def __init__(self, max_size=5, cache_dir='cache_dir'):
         self.max_size = max_size
+        self.cache_dir = cache_dir
         self.cache = OrderedDict()  # 键：文件路径（唯一ID），值：Reader对象
+        self._pending = {}  # 键：文件路径，值：正在创建Reader的Future
+        self._lock = threading.Lock()
 
-    def get(self, file_path):
-        """获取已存在的Reader对象（更新使用时间）"""
+    def _get(self, file_path):
+        # 调用方需持有 self._lock
         if file_path not in self.cache:
             return None
         # 将对象移到末尾表示最近使用
         self.cache.move_to_end(file_path)
         return self.cache[file_path]
 
-    def add(self, file_path):
-        """添加新Reader对象（自动执行LRU淘汰）"""
-        # 若已存在则直接返回并更新顺序
-        if file_path in self.cache:
-            return self.get(file_path)
-
-        # 创建新Reader对象（实际使用时可替换为具体的读取器创建逻辑）
-        new_reader = open_slide(file_path)
-
-        # 缓存已满时淘汰最久未使用的对象
-        if len(self.cache) >= self.max_size:
-            lru_key, _ = self.cache.popitem(last=False)
-            logger.info(f"[ LRUReaderCache ] LRU淘汰: {lru_key}")
+    def get(self, file_path):
+        """获取已存在的Reader对象（更新使用时间）"""
+        with self._lock:
+            return self._get(file_path)
 
-        # 添加新对象并标记为最近使用（移到末尾）
-        self.cache[file_path] = new_reader
-        self.cache.move_to_end(file_path)
+    def add(self, file_path):
+        """添加新Reader对象（自动执行LRU淘汰）
+
+        同一路径并发未命中时只创建一个Reader，其余调用方等待其结果。
+        """
+        with self._lock:
+            # 若已存在则直接返回并更新顺序
+            reader = self._get(file_path)
+            if reader is not None:
+                return reader
+
+            future = self._pending.get(file_path)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._pending[file_path] = future
+
+        if not is_owner:
+            return future.result()
+
+        # 创建新Reader对象（在锁外执行，避免阻塞其他路径）
+        try:
+            new_reader = open_slide(file_path, cache_dir=self.cache_dir)
+        except BaseException as e:
+            with self._lock:
+                self._pending.pop(file_path, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            # 缓存已满时淘汰最久未使用的对象
+            if len(self.cache) >= self.max_size:
+                lru_key, lru_reader = self.cache.popitem(last=False)
+                lru_reader.release_pages()
+                logger.info(f"[ LRUReaderCache ] LRU淘汰: {lru_key}")
+
+            # 新插入的键已位于 OrderedDict 末尾，无需再 move_to_end
+            self.cache[file_path] = new_reader
+            self._pending.pop(file_path, None)
+
+        future.set_result(new_reader)
         return new_reader
 
+    def remove(self, file_path):
+        """移除指定的Reader对象（如切片被删除时）"""
+        with self._lock:
+            reader = self.cache.pop(file_path, None)
+        if reader is not None:
+            reader.release_pages()
+            reader.close()
+        return reader
+
     def __len__(self):
         """获取当前缓存大小"""
-        return len(self.cache)
+        with self._lock:
+            return len(self.cache)
 
 
 # 示例用法
@@ -1,15 +1,19 @@
 import re
-from xmltodict import parse
+import json
 import logging
 import math
+import mmap
 import os
+import threading
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 import pyvips
+from PIL import Image
 
 logger = logging.getLogger(__name__)
 
@@ -20,11 +24,35 @@ IMPORTANT_WSI_PROPERTIES = ['width', 'height', 'tile_width', 'tile_height', 'mpp
 REQUIRED_WSI_PROPERTIES = ['width', 'height', 'tile_size', 'mpp',
                            'level_count', 'level_downsamples', 'level_dimensions']
 
-GENERAL_IMAGE_FORMATS = set(['.jpg', '.jpeg', '.tif', '.tiff', '.png', '.bmp'])
+GENERAL_IMAGE_FORMATS = frozenset(['.jpg', '.jpeg', '.tif', '.tiff', '.png', '.bmp'])
 WSI_IMAGE_FORMAT_COMMON = ['.svs', '.tif', '.tiff',
                            '.ndpi', '.vms', '.vmu', '.scn', '.mrxs']
 WSI_IMAGE_FORMAT_ZH = ['.sdpc', '.kfb', '.tmap']
-WSI_IMAGE_FORMAT = set(WSI_IMAGE_FORMAT_COMMON + WSI_IMAGE_FORMAT_ZH)
+WSI_IMAGE_FORMAT = frozenset(WSI_IMAGE_FORMAT_COMMON + WSI_IMAGE_FORMAT_ZH)
+
+# 超过以下阈值的 tif/png 交给 WSIReader，由 pyvips 顺序读取一遍生成金字塔 TIFF，避免整图解码到内存
+LARGE_IMAGE_FORMATS = frozenset(['.tif', '.tiff', '.png'])
+LARGE_IMAGE_FILE_SIZE = 256 * 1024 * 1024  # 256MB
+LARGE_IMAGE_DIMENSION = 16384
+
+# 各格式文件头的魔数（.mrxs/.vms/.kfb 等没有固定文件头的格式不做检查）
+_TIFF_MAGIC = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')  # TIFF / BigTIFF
+IMAGE_MAGIC_BYTES = {
+    '.jpg': (b'\xff\xd8\xff',),
+    '.jpeg': (b'\xff\xd8\xff',),
+    '.png': (b'\x89PNG\r\n\x1a\n',),
+    '.bmp': (b'BM',),
+    '.tif': _TIFF_MAGIC,
+    '.tiff': _TIFF_MAGIC,
+    '.svs': _TIFF_MAGIC,
+    '.ndpi': _TIFF_MAGIC,
+    '.scn': _TIFF_MAGIC,
+}
+
+# image-description 中的 mpp / 放大倍数
+# 例: 'Aperio Image Format\r\n88115x78739 [0,0 88115x78739] (256x256) JPEG/RGB Q=60|AppMag = 40|MPP = 0.247877'
+_MPP_RE = re.compile(r'MPP\s*=\s*([\d.]+)')
+_MAG_RE = re.compile(r'AppMag\s*=\s*([\d.]+)')
 
 
 def read_wsi_metadata(slide_path):
@@ -67,15 +95,13 @@ def read_wsi_metadata(slide_path):
         del metadata[k]
 
     # 获取 mpp
-    # metadata['image-description']: 'Aperio Image Format\r\n88115x78739 [0,0 88115x78739] (256x256) JPEG/RGB Q=60|AppMag = 40|MPP = 0.247877'
-    mpp_pat = r'MPP\s*=\s*([\d.]+)'
-    match = re.search(mpp_pat, metadata['image-description'])
+    image_description = metadata.get('image-description', '')
+    match = _MPP_RE.search(image_description)
     mpp = float(match.group(1)) if match else None
     metadata['mpp'] = mpp
 
     # 获取放大倍数
-    mag_pat = r'AppMag\s*=\s*([\d.]+)'
-    match = re.search(mag_pat, metadata['image-description'])
+    match = _MAG_RE.search(image_description)
     mag = float(match.group(1)) if match else None
     metadata['mag'] = mag
 
@@ -87,6 +113,28 @@ def read_wsi_metadata(slide_path):
     return metadata
 
 
+def sniff_image_header(filename: str, head: bytes) -> bool:
+    """根据文件头判断文件内容是否与扩展名对应的图像格式一致
+
+    只需文件开头的少量字节，用于在上传完整文件之前提前拒绝无效文件。
+    """
+    magics = IMAGE_MAGIC_BYTES.get(Path(filename).suffix.lower())
+    if magics is None:
+        return True
+    return head.startswith(magics)
+
+
+def _downsample(img: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """将 RGB 图像缩小到 size=(W, H)
+
+    uint8 图像使用 Pillow 的 BOX 滤波（安装 Pillow-SIMD 时为 AVX2 实现），
+    其他类型回退到 cv2.resize(INTER_AREA)。
+    """
+    if img.dtype != np.uint8:
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return np.asarray(Image.fromarray(img).resize(size, Image.BOX))
+
+
 def generate_dzi_image(slide_path, outpath=None):
     """
     [demo]
@@ -97,15 +145,18 @@ def generate_dzi_image(slide_path, outpath=None):
     """
 
     # Load the slide
-    image = pyvips.Image.new_from_file(slide_path)
+    image = pyvips.Image.new_from_file(slide_path, access="sequential")
 
     # Generate the DZI image
     outpath = outpath or Path(slide_path).name
     # pyvips: enum 'VipsForeignDzDepth' has no member 'all', should be one of: onepixel, onetile, one
     # 每层下采样 2 倍（默认值）
+    # 所有tile写入单个不压缩的 zip（JPEG 已压缩），避免产生大量小文件
     image.dzsave(outpath, tile_size=512, overlap=0,
                  depth='onetile',
-                 suffix='.jpg')
+                 suffix='.jpg',
+                 container='zip',
+                 compression=0)
 
 
 class BaseReader:
@@ -113,6 +164,8 @@ class BaseReader:
         self.slide_path = slide_path
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # 每个切片的缓存单独存放在一个子目录中，删除切片时整体删除即可
+        self.slide_cache_dir = self.cache_dir / Path(slide_path).name
         self.__slide_info = None
         self.pyramid = None
 
@@ -124,6 +177,9 @@ class BaseReader:
     def slide_info(self, value):
         self.__slide_info = value
 
+    def release_pages(self):
+        """释放读取器占用的物理内存（从缓存淘汰时调用），默认无需处理"""
+
     @abstractmethod
     def open_slide(self, slide_path: str) -> Tuple[bool, Optional[Dict]]:
         raise NotImplementedError
@@ -133,8 +189,66 @@ class BaseReader:
                  size: int = 512) -> Union[bytes, np.ndarray]:
         raise NotImplementedError
 
+    def read_tile(self, slide_path: str, x: int, y: int, level: int,
+                  size: int = 512) -> Optional[bytes]:
+        """读取tile的JPEG字节"""
+        return self.get_tile(slide_path, x, y, level, size)
+
+    def close(self):
+        """关闭读取器持有的文件句柄（切片被删除时调用），默认无需处理"""
+
 
 class PngLikeReader(BaseReader):
+    # 金字塔缓存清单：记录 slide 信息，存在即表示各层 .npy 已完整写出
+    PYRAMID_MANIFEST = 'pyramid.json'
+
+    def __init__(self, slide_path, cache_dir='cache_dir'):
+        super().__init__(slide_path, cache_dir=cache_dir)
+        # 防止并发打开时重复生成金字塔（写 .npy 时其他线程可能正 mmap 同一文件）
+        self._open_lock = threading.Lock()
+
+    def _pyramid_level_path(self, level: int) -> Path:
+        return self.slide_cache_dir / f'pyramid_L{level}.npy'
+
+    def _load_cached_pyramid(self) -> Optional[Dict]:
+        """从磁盘缓存以 mmap 方式加载金字塔，由操作系统按需换入tile所在的行"""
+        manifest_path = self.slide_cache_dir / self.PYRAMID_MANIFEST
+        if not manifest_path.exists():
+            return None
+
+        with open(manifest_path, 'r') as f:
+            info = json.load(f)
+
+        self.pyramid = [np.load(self._pyramid_level_path(level), mmap_mode='r')
+                        for level in range(info['level_count'])]
+
+        # 最高分辨率层以随机tile访问为主，关闭内核预读
+        self._madvise(self.pyramid[0], 'MADV_RANDOM')
+        return info
+
+    @staticmethod
+    def _madvise(level_image: np.ndarray, advice: str):
+        buf = getattr(level_image, '_mmap', None)
+        if buf is not None and hasattr(mmap, advice):
+            buf.madvise(getattr(mmap, advice))
+
+    def release_pages(self):
+        """丢弃 mmap 金字塔的驻留页，数据仍在磁盘缓存中，再次访问时按需换入"""
+        for level_image in self.pyramid or []:
+            self._madvise(level_image, 'MADV_DONTNEED')
+
+    def close(self):
+        """释放 mmap 金字塔（删除缓存目录前调用）"""
+        self.pyramid = None
+
+    def _save_manifest(self, info: Dict):
+        """各层 .npy 写完后写入清单"""
+        manifest_path = self.slide_cache_dir / self.PYRAMID_MANIFEST
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp_path, manifest_path)
+
     def _build_pyramid(self, slide_path: str,
                        min_dimension=512  # 最小的tile尺寸
                        ):
@@ -142,8 +256,16 @@ class PngLikeReader(BaseReader):
             logger.error(f"文件不存在: {slide_path}")
             return False, None
 
-        # 读取原始图像
-        img = cv2.imread(str(slide_path))
+        # 已有金字塔缓存时直接 mmap 加载，无需重新解码和缩放
+        info = self._load_cached_pyramid()
+        if info is not None:
+            logger.info(f"使用金字塔缓存: {self.slide_cache_dir}")
+            self.slide_info = info
+            return True, info
+
+        # 读取原始图像（numpy 读文件 + imdecode，绕开 imread 在 Windows 上的路径编码问题）
+        img = cv2.imdecode(np.fromfile(slide_path, dtype=np.uint8),
+                           cv2.IMREAD_COLOR)
         if img is None:
             logger.error(f"无法读取图像: {slide_path}")
             return False, None
@@ -197,53 +319,67 @@ class PngLikeReader(BaseReader):
         }
 
         # 生成金字塔缓存
-        pyramid = []
-        current_image = img
-        for level, (target_w, target_h) in enumerate(level_dimensions):
-            if level == 0:
-                pyramid.append(current_image)
-            else:
-                resized = cv2.resize(current_image, (target_w, target_h),
-                                     interpolation=cv2.INTER_AREA)
-                pyramid.append(resized)
-                current_image = resized
+        # 目标尺寸恰为上一层一半时使用 pyrDown（固定 5-tap 可分离核，SIMD 优化），
+        # 只有触发 min_dimension 钳制时才回退到 _downsample
+        # 每层依赖上一层，缩放只能串行；每层生成后立即交给线程池写 .npy，
+        # 与下一层的缩放重叠（cv2 和 np.save 都会释放 GIL）
+        self.slide_cache_dir.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            saves = [executor.submit(np.save, self._pyramid_level_path(0), img)]
+            actual_dimensions = [(width, height)]
+            current_image = img
+            for level, (target_w, target_h) in enumerate(level_dimensions[1:], 1):
+                prev_h, prev_w = current_image.shape[:2]
+                if (target_w, target_h) == (prev_w // 2, prev_h // 2):
+                    current_image = cv2.pyrDown(current_image,
+                                                dstsize=(target_w, target_h))
+                else:
+                    current_image = _downsample(current_image, (target_w, target_h))
+                saves.append(executor.submit(
+                    np.save, self._pyramid_level_path(level), current_image))
+                # 以实际生成的尺寸为准
+                actual_dimensions.append(
+                    (current_image.shape[1], current_image.shape[0]))
+
+            for future in saves:
+                future.result()
+        info['level_dimensions'] = actual_dimensions
+
+        # 写入磁盘缓存后改用 mmap 版本，释放堆上的金字塔副本
+        self._save_manifest(info)
+        del saves, current_image, img
+        info = self._load_cached_pyramid()
 
         logger.info(f"成功打开图像文件: {slide_path}")
         self.slide_info = info
-        self.pyramid = pyramid
         return True, info
 
     def open_slide(self, slide_path: str) -> Tuple[bool, Optional[Dict]]:
         # """
-        if self.slide_info is None:
-            try:
-                return self._build_pyramid(slide_path)
-            except Exception as e:
-                logger.error(f"[ open_slide ] 打开图像失败: {str(e)}")
-                return False, None
+        with self._open_lock:
+            if self.slide_info is None:
+                try:
+                    return self._build_pyramid(slide_path)
+                except Exception as e:
+                    logger.error(f"[ open_slide ] 打开图像失败: {str(e)}")
+                    return False, None
 
-        return True, self.slide_info
+            return True, self.slide_info
 
     def get_tile(self,
                  slide_path: str,
                  x: int,
                  y: int,
                  level: int,
-                 size: int = 512) -> Optional[str]:
-        """获取指定位置的tile"""
+                 size: int = 512) -> Optional[bytes]:
+        """获取指定位置的tile，返回JPEG字节
+
+        不再单独写磁盘文件，编码结果由路由层的 tile 缓存（diskcache）统一保存。
+        """
         try:
-            # 生成缓存文件名
-            slide_id = Path(slide_path).stem
-            cache_file = self.cache_dir / \
-                f"{slide_id}_{level}_{x}_{y}_{size}.jpg"
             logger.debug(
                 f'[ get_tile ] 请求tile: path={slide_path}, x={x}, y={y}, level={level}')
 
-            # 检查缓存
-            if cache_file.exists():
-                logger.debug(f'[ get_tile ] 使用缓存: {cache_file}')
-                return str(cache_file)
-
             # 获取切片信息
             slide_info = self.slide_info
             if slide_info is None:
@@ -278,45 +414,36 @@ class PngLikeReader(BaseReader):
             # 提取tile区域
             tile = level_image[tile_y:end_y, tile_x:end_x]
 
-            # 处理边缘tile的填充
-            if tile.shape[0] != size or tile.shape[1] != size:
-                logger.debug(
-                    f'[ get_tile ] 填充tile边缘: 从{tile.shape}到{size}x{size}')
-                full_tile = np.full((size, size, 3), 255, dtype=np.uint8)
-                full_tile[:tile.shape[0], :tile.shape[1]] = tile
-                tile = full_tile
-
-            # 保存为JPEG
-            cv2.imwrite(str(cache_file), cv2.cvtColor(tile, cv2.COLOR_RGB2BGR))
-            logger.debug(f'[ get_tile ] 保存 tile => {cache_file}')
-
-            return str(cache_file)
+            # 编码为JPEG（libvips/libjpeg-turbo 直接编码 RGB，无需转换为 BGR；
+            # 边缘tile在编码流水线中填充白边，不再分配整块填充缓冲区）
+            return self._encode_jpeg(tile, size)
 
         except Exception as e:
             logger.error(f'[ get_tile ] 获取tile失败: {str(e)}')
             return None
 
+    @staticmethod
+    def _encode_jpeg(tile: np.ndarray, size: int, quality: int = 80) -> bytes:
+        """编码为JPEG字节"""
+        tile = np.ascontiguousarray(tile)
+        height, width = tile.shape[:2]
+        image = pyvips.Image.new_from_memory(tile.data, width, height, 3, 'uchar')
 
-def _extract_slide_info_from_dzi(dzi_path: str) -> Optional[Dict]:
-    # 从 dzi 文件中提取 slide 信息
-    with open(dzi_path, 'r') as f:
-        xml = f.read()
+        # 处理边缘tile的填充
+        if width != size or height != size:
+            logger.debug(
+                f'[ get_tile ] 填充tile边缘: 从{tile.shape}到{size}x{size}')
+            image = image.embed(0, 0, size, size, extend='white')
 
-    xml_dict = parse(xml)
-    dzi_info = dict(format=xml_dict['Image']['@Format'],
-                    overlap=int(xml_dict['Image']['@Overlap']),
-                    tile_size=int(xml_dict['Image']['@TileSize']),
-                    width=int(xml_dict['Image']['Size']['@Width']),
-                    height=int(xml_dict['Image']['Size']['@Height']))
+        return image.jpegsave_buffer(Q=quality, strip=True)
 
-    # 从 dzi 目录中提取 slide 信息
-    dzi_dir = dzi_path[:-4] + '_files'
-    level_count = len([p for p in Path(dzi_dir).glob('**/*') if p.is_dir()])
-    dzi_info['level_count'] = level_count
 
-    # 生成金字塔层级信息
-    width, height = dzi_info['width'], dzi_info['height']
-    tile_size = dzi_info['tile_size']
+def _pyramid_levels(width: int, height: int, tile_size: int,
+                    level_count: Optional[int] = None) -> Dict:
+    """生成金字塔层级信息（每层下采样 2 倍，直到一个 tile 能容纳整幅图像）"""
+    if level_count is None:
+        level_count = max(1, math.ceil(
+            math.log2(max(width, height) / tile_size)) + 1)
 
     level_dimensions = []
     level_downsamples = []
@@ -331,73 +458,231 @@ def _extract_slide_info_from_dzi(dzi_path: str) -> Optional[Dict]:
         current_width = max(current_width // 2, tile_size)
         current_height = max(current_height // 2, tile_size)
 
-    dzi_info['level_dimensions'] = level_dimensions
-    dzi_info['level_downsamples'] = level_downsamples
+    return dict(level_count=level_count,
+                level_dimensions=level_dimensions,
+                level_downsamples=level_downsamples)
 
-    return dzi_info
+
+# 选择原生层级时下采样倍数的容差
+NATIVE_LEVEL_TOLERANCE = 1.01
 
 
 class WSIReader(BaseReader):
+    """读取 WSI 及大尺寸普通图像的 tile
+
+    按请求的 tile 大小，用 pyvips 从最接近的原生层级裁剪、缩放并编码 tile。
+    openslide 可识别的切片直接使用其原生层级；没有原生层级的大图（tif/png 等）
+    首次打开时顺序读取一遍，生成分块的金字塔 TIFF 作为原生层级，避免随机访问整图解码
+    以及从原图整层缩放。
+    """
+    TILE_SIZE = 512
+    # slide 信息缓存的格式版本，格式变化时递增，旧缓存会被忽略并重新生成
+    META_VERSION = 3
+
+    def __init__(self, slide_path, cache_dir='cache_dir'):
+        super().__init__(slide_path, cache_dir=cache_dir)
+        # 没有原生层级的图像生成的金字塔 TIFF
+        self.pyramid_path = self.slide_cache_dir / f'{Path(slide_path).name}.pyramid.tif'
+        # 首次打开后保存 slide 信息，之后的打开不再读取原图元数据
+        self.meta_path = self.slide_cache_dir / f'{Path(slide_path).name}.meta.json'
+        # 各原生层级 [(下采样倍数, pyvips.Image)]，渲染 tile 时使用
+        self._levels = None
+        # 防止并发打开时重复生成金字塔
+        self._open_lock = threading.Lock()
+
+    def _load_meta(self) -> Optional[Dict]:
+        """读取缓存的 slide 信息，不存在时返回 None"""
+        if not self.meta_path.exists():
+            return None
+        with open(self.meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != self.META_VERSION:
+            logger.info(f'[ open_slide ] slide 信息缓存已过期: {self.meta_path}')
+            return None
+        return meta['slide_info']
+
+    def _save_meta(self, slide_info: Dict):
+        self.slide_cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.meta_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(version=self.META_VERSION,
+                           slide_info=slide_info), f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _build_pyramid_tiff(self, slide_path: str):
+        """顺序读取原图生成分块金字塔 TIFF（先写临时文件，完成后再改名）"""
+        self.slide_cache_dir.mkdir(parents=True, exist_ok=True)
+        partial_path = self.pyramid_path.with_name(
+            f'{Path(slide_path).name}.partial.tif')
+        logger.info(f'[ build_pyramid ] 生成金字塔: {self.pyramid_path}')
+
+        image = pyvips.Image.new_from_file(slide_path, access='sequential')
+        if image.hasalpha():
+            image = image.flatten(background=255)
+        # 8 位图像用 JPEG 压缩，其他位深用无损 deflate
+        compression = 'jpeg' if image.format == 'uchar' else 'deflate'
+        image.tiffsave(str(partial_path), tile=True, tile_width=256,
+                       tile_height=256, pyramid=True, bigtiff=True,
+                       compression=compression, Q=90)
+        os.replace(partial_path, self.pyramid_path)
+
+    def _read_slide_info(self, slide_path: str) -> Dict:
+        # 没有原生层级的图像先生成金字塔
+        if not self.pyramid_path.exists() and not _has_native_levels(slide_path):
+            self._build_pyramid_tiff(slide_path)
+
+        # 直接从原始图像中读取 slide 信息，合并金字塔信息
+        slide_info = read_wsi_metadata(slide_path)
+        slide_info.update(format='jpg', overlap=0, tile_size=self.TILE_SIZE)
+        slide_info.update(_pyramid_levels(
+            slide_info['width'], slide_info['height'], self.TILE_SIZE))
+        return slide_info
+
+    def _open_levels(self, slide_path: str):
+        """打开原图（或生成的金字塔 TIFF）及其原生层级（只读取文件头，像素按需解码）"""
+        if self.pyramid_path.exists():
+            # 金字塔 TIFF 的每一页为一个层级
+            source = str(self.pyramid_path)
+            base = pyvips.Image.new_from_file(source)
+            levels = [(1.0, base)]
+            n_pages = base.get('n-pages') if base.get_typeof('n-pages') else 1
+            for i in range(1, n_pages):
+                page = pyvips.Image.new_from_file(source, page=i)
+                levels.append((base.width / page.width, page))
+            self._levels = levels
+            return
+
+        base = pyvips.Image.new_from_file(slide_path)
+        levels = [(1.0, base)]
+        # openslideload 会给出原生层级，缩小的 tile 从最接近的层级读取
+        if base.get_typeof('openslide.level-count'):
+            for i in range(1, int(base.get('openslide.level-count'))):
+                downsample = float(base.get(f'openslide.level[{i}].downsample'))
+                levels.append(
+                    (downsample, pyvips.Image.new_from_file(slide_path, level=i)))
+        self._levels = levels
 
     def open_slide(self, slide_path: str) -> Tuple[bool, Optional[Dict]]:
 
         # """
-        if self.slide_info is None:
-            try:
+        with self._open_lock:
+            if self.slide_info is None:
+                try:
+                    if not os.path.exists(slide_path):
+                        logger.error(f"文件不存在: {slide_path}")
+                        return False, None
 
-                # 构建金字塔
-                status, dzi_path = self._build_pyramid(slide_path)
+                    # 已有缓存的 slide 信息
+                    slide_info = self._load_meta()
+                    if slide_info is None:
+                        slide_info = self._read_slide_info(slide_path)
+                        self._save_meta(slide_info)
 
-                # 从 dzi 读取 slide 信息
-                dzi_info = _extract_slide_info_from_dzi(dzi_path)
+                    self._open_levels(slide_path)
+                    self.slide_info = slide_info
 
-                # 直接从原始图像中读取 slide 信息
-                slide_info = read_wsi_metadata(slide_path)
+                    return True, slide_info
 
-                # 合并 slide 信息
-                slide_info.update(dzi_info)
+                except Exception as e:
+                    logger.error(f"[ open_slide ] 打开图像失败: {str(e)}")
+                    return False, None
 
-                self.slide_info = slide_info
+            return True, self.slide_info
 
-                return status, slide_info
+    def get_tile(self, slide_id: str, x: int, y: int, level: int,
+                 size: int = 512) -> Optional[bytes]:
+        """获取tile的JPEG字节（按请求的 size 渲染）"""
+        try:
+            return self._render_tile(x, y, level, size)
+        except Exception as e:
+            logger.error(f'[ get_tile ] 渲染tile失败: {str(e)}')
+            return None
 
-            except Exception as e:
-                logger.error(f"[ open_slide ] 打开图像失败: {str(e)}")
-                return False, None
+    def _render_tile(self, x: int, y: int, level: int,
+                     size: int) -> Optional[bytes]:
+        """从原图裁剪 tile 对应区域并缩放、编码为 JPEG"""
+        width, height = self._levels[0][1].width, self._levels[0][1].height
+        if not 0 <= level < self.slide_info['level_count']:
+            logger.error(
+                f'[ get_tile ] 无效的level: {level}, 最大level: {self.slide_info["level_count"] - 1}')
+            return None
 
-        return True, self.slide_info
+        # tile 在原图（level 0）坐标系中的位置
+        downsample = 2 ** level
+        left, top = x * size * downsample, y * size * downsample
+        if left >= width or top >= height:
+            logger.error(
+                f'[ get_tile ] tile坐标超出范围: x={left}/{width}, y={top}/{height}')
+            return None
 
-    def get_tile(self, slide_id: str, x: int, y: int, level: int,
-                 size: int = 512):
-        new_level = self.slide_info['level_count'] - 1 - level
-        tile_path = f'{self.cache_dir}/{Path(slide_id).name}_files/{new_level}/{x}_{y}.jpg'
-        return tile_path
+        # 选择下采样倍数不超过目标倍数的最粗原生层级，剩余部分由 resize 完成；
+        # openslide 给出的倍数并非精确的 2 的幂（如 4.000112、16.00713），比较时留 1% 容差
+        native_downsample, image = max(
+            (item for item in self._levels
+             if item[0] <= downsample * NATIVE_LEVEL_TOLERANCE),
+            key=lambda item: item[0])
+        scale = downsample / native_downsample
+        if scale <= NATIVE_LEVEL_TOLERANCE:
+            # 与原生层级只差浮点误差时直接裁剪，不再重采样
+            scale = 1.0
+        native_left = min(int(left / native_downsample), image.width - 1)
+        native_top = min(int(top / native_downsample), image.height - 1)
+        region = image.crop(native_left, native_top,
+                            min(math.ceil(size * scale), image.width - native_left),
+                            min(math.ceil(size * scale), image.height - native_top))
+
+        if scale > 1:
+            region = region.resize(1 / scale)
+        # openslide 输出 RGBA，空白区域 alpha 为 0，按白色背景合成
+        if region.hasalpha():
+            region = region.flatten(background=255)
+
+        return region.jpegsave_buffer(Q=80, strip=True)
+
+    def read_tile(self, slide_path: str, x: int, y: int, level: int,
+                  size: int = 512) -> Optional[bytes]:
+        if self.slide_info is None:
+            success, _ = self.open_slide(slide_path)
+            if not success:
+                return None
 
-    def _build_pyramid(self, slide_path: str):
-        if not os.path.exists(slide_path):
-            logger.error(f"文件不存在: {slide_path}")
-            return False, None
+        return self.get_tile(slide_path, x, y, level, size)
+
+    def close(self):
+        self._levels = None
+
+
+def _has_native_levels(slide_path: str) -> bool:
+    """图像是否由 openslide 读取并带有原生多分辨率层级（只读取文件头）"""
+    img = pyvips.Image.new_from_file(slide_path)
+    return bool(img.get_typeof('openslide.level-count'))
 
-        # 检查文件是否已经处理过
-        dzi_path = f'{self.cache_dir}/{Path(slide_path).name}.dzi'
-        if os.path.exists(dzi_path):
-            logger.debug(f'[ build_pyramid ] 已存在: {dzi_path}')
-            return True, dzi_path
 
-        outpath = f'{self.cache_dir}/{Path(slide_path).name}'
-        generate_dzi_image(slide_path, outpath=outpath)
-        return True, dzi_path
+def _is_large_image(slide_path: str) -> bool:
+    """判断图像是否过大，不适合整图解码（只读取文件头）"""
+    try:
+        if os.path.getsize(slide_path) > LARGE_IMAGE_FILE_SIZE:
+            return True
+        img = pyvips.Image.new_from_file(slide_path, access="sequential")
+        return max(img.width, img.height) > LARGE_IMAGE_DIMENSION
+    except Exception as e:
+        logger.debug(f'[ _is_large_image ] 无法读取图像尺寸: {str(e)}')
+        return False
 
 
-def open_slide(slide_path: str) -> PngLikeReader | WSIReader:
+def open_slide(slide_path: str,
+               cache_dir: str = 'cache_dir') -> PngLikeReader | WSIReader:
     """Open a whole-slide or regular image.
 
     Return an OpenSlide object for whole-slide images and an ImageSlide
     object for other types of images."""
-    if Path(slide_path).suffix in GENERAL_IMAGE_FORMATS:
-        return PngLikeReader(slide_path)
+    # 扩展名不区分大小写（如 .JPG）
+    suffix = Path(slide_path).suffix.lower()
+    if suffix in GENERAL_IMAGE_FORMATS and not (
+            suffix in LARGE_IMAGE_FORMATS and _is_large_image(slide_path)):
+        return PngLikeReader(slide_path, cache_dir=cache_dir)
 
-    return WSIReader(slide_path)
+    return WSIReader(slide_path, cache_dir=cache_dir)
 
 
 if __name__ == '__main__':
@@ -406,5 +691,5 @@ if __name__ == '__main__':
     slide_obj = open_slide(slide_path)
     status, slide_info = slide_obj.open_slide(slide_path)
     print(status, slide_info)
-    tile_path = slide_obj.get_tile(slide_path, 6, 48, 7, 512)
+    tile = slide_obj.read_tile(slide_path, 6, 48, 7, 512)
     a = 0
@@ -1,26 +1,142 @@
 import logging
+import math
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, List, Optional, Tuple
 
 from .lru_reader_cache import LRUReaderCache
 
 logger = logging.getLogger(__name__)
 
+# 后台预取相邻tile的线程数和最大排队数（超出时丢弃，避免预取任务堆积）
+PREFETCH_WORKERS = 2
+PREFETCH_MAX_INFLIGHT = 32
+
+# (x, y, level, size)
+Tile = Tuple[int, int, int, int]
+
 
 class WSIService:
     def __init__(self, cache_dir: str):
         self.cache_dir = cache_dir
         Path(cache_dir).mkdir(parents=True, exist_ok=True)
-        self._reader_cache = LRUReaderCache()
+        self._reader_cache = LRUReaderCache(cache_dir=cache_dir)
+        self._prefetch_executor = ThreadPoolExecutor(
+            max_workers=PREFETCH_WORKERS, thread_name_prefix='tile-prefetch')
+        self._prefetch_slots = threading.BoundedSemaphore(PREFETCH_MAX_INFLIGHT)
+        # 正在生成的tile，键为 (slide_path, x, y, level, size)，值为Future；
+        # 请求与预取共用，同一tile不会被并发生成两次
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
     def open_slide(self, slide_path: str):
         slide_obj = self._reader_cache.add(slide_path)
         return slide_obj.open_slide(slide_path)
 
-    def get_tile(self,
-                 slide_path: str,
-                 x: int,
-                 y: int,
-                 level: int,
-                 size: int = 512):
-        slide_obj = self._reader_cache.add(slide_path)
-        return slide_obj.get_tile(slide_path, x, y, level, size)
+    def read_tile(self,
+                  slide_path: str,
+                  x: int,
+                  y: int,
+                  level: int,
+                  size: int = 512,
+                  wait: bool = True) -> Optional[bytes]:
+        """生成tile，同一tile正在生成时等待其结果（wait=False 时直接返回 None）"""
+        key = (slide_path, x, y, level, size)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._inflight[key] = future
+
+        if not is_owner:
+            return future.result() if wait else None
+
+        try:
+            slide_obj = self._reader_cache.add(slide_path)
+            data = slide_obj.read_tile(slide_path, x, y, level, size)
+        except BaseException as e:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._inflight_lock:
+            self._inflight.pop(key, None)
+        future.set_result(data)
+        return data
+
+    def prefetch_neighbors(self,
+                           slide_path: str,
+                           x: int,
+                           y: int,
+                           level: int,
+                           size: int,
+                           is_cached: Callable[[Tile], bool],
+                           on_tile: Callable[[Tile, bytes], None]):
+        """在后台生成相邻tile（同层上下左右及上下层对应位置）
+
+        is_cached 返回 True 的tile跳过，生成成功后调用 on_tile 写入缓存。
+        尽力而为：排队已满时直接丢弃，不阻塞调用方。
+        """
+        for tile in self._neighbor_tiles(slide_path, x, y, level, size):
+            if not self._prefetch_slots.acquire(blocking=False):
+                return
+            self._prefetch_executor.submit(
+                self._prefetch_tile, slide_path, tile, is_cached, on_tile)
+
+    def _neighbor_tiles(self, slide_path: str, x: int, y: int, level: int,
+                        size: int) -> List[Tile]:
+        tiles = [(x - 1, y, level), (x + 1, y, level),
+                 (x, y - 1, level), (x, y + 1, level),
+                 (x // 2, y // 2, level + 1)]
+        if level > 0:
+            tiles.append((2 * x, 2 * y, level - 1))
+
+        # 已打开的切片按各层尺寸过滤越界的tile。_pyramid_levels 给出的层级尺寸
+        # 不小于一个 tile（低分辨率层被放大），而读取器按原图尺寸 / 2**level 判断越界，
+        # 因此取两者较小值，避免预取必然失败的tile
+        slide_obj = self._reader_cache.get(slide_path)
+        level_dimensions = None
+        if slide_obj is not None and slide_obj.slide_info is not None:
+            level_dimensions = slide_obj.slide_info['level_dimensions']
+
+        neighbors = []
+        for nx, ny, nlevel in tiles:
+            if nx < 0 or ny < 0:
+                continue
+            if level_dimensions is not None:
+                if nlevel >= len(level_dimensions):
+                    continue
+                width, height = level_dimensions[nlevel]
+                base_width, base_height = level_dimensions[0]
+                width = min(width, math.ceil(base_width / 2 ** nlevel))
+                height = min(height, math.ceil(base_height / 2 ** nlevel))
+                if nx * size >= width or ny * size >= height:
+                    continue
+            neighbors.append((nx, ny, nlevel, size))
+        return neighbors
+
+    def _prefetch_tile(self, slide_path: str, tile: Tile,
+                       is_cached: Callable[[Tile], bool],
+                       on_tile: Callable[[Tile, bytes], None]):
+        try:
+            if is_cached(tile):
+                return
+            x, y, level, size = tile
+            # 该tile正由请求或其他预取生成时跳过，由其负责写入缓存
+            data = self.read_tile(slide_path, x, y, level, size, wait=False)
+            if data is not None:
+                on_tile(tile, data)
+        except Exception as e:
+            logger.debug(f'[ prefetch ] 预取tile失败: {tile}, {str(e)}')
+        finally:
+            self._prefetch_slots.release()
+
+    def close_slide(self, slide_path: str):
+        self._reader_cache.remove(slide_path)
+
+    def close(self):
+        """停止后台预取"""
+        self._prefetch_executor.shutdown(wait=False, cancel_futures=True)
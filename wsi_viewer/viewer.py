@@ -1,6 +1,8 @@
+import json
 import logging
 import os
 import shutil
+import socket
 import subprocess
 import sys
 import time
@@ -8,6 +10,11 @@ from pathlib import Path
 from typing import Optional, Union
 
 
+# 等待后端端口就绪的超时时间和轮询间隔（秒）
+BACKEND_READY_TIMEOUT = 10
+BACKEND_READY_INTERVAL = 0.05
+
+
 class WSIViewer:
     def __init__(self, host: str = "0.0.0.0", 
                  backend_port: int = 5000,
@@ -41,21 +48,47 @@ class WSIViewer:
         self.npm_path = None
         self.backend_process = None
         self.frontend_process = None
+        # 记录已安装依赖对应的 requirements/package-lock 修改时间，未变化时跳过安装
+        self.deps_marker = self.static_dir / ".deps_ok"
+
+    def _read_deps_marker(self) -> dict:
+        try:
+            return json.loads(self.deps_marker.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _deps_up_to_date(self, name: str, path: Path) -> bool:
+        """依赖文件自上次成功安装后未修改"""
+        return self._read_deps_marker().get(name) == path.stat().st_mtime
+
+    def _mark_deps_ok(self, name: str, path: Path) -> None:
+        marker = self._read_deps_marker()
+        marker[name] = path.stat().st_mtime
+        self.deps_marker.parent.mkdir(parents=True, exist_ok=True)
+        self.deps_marker.write_text(json.dumps(marker))
 
     def install_dependencies(self) -> bool:
         """安装必要的Python依赖"""
-        self.logger.info("安装Python依赖...")
         requirements_path = self.project_root / "requirements-vis.txt"
         if requirements_path.exists():
+            if self._deps_up_to_date("requirements-vis.txt", requirements_path):
+                self.logger.info("Python依赖已是最新，跳过安装")
+                return True
+
+            self.logger.info("安装Python依赖...")
             try:
                 subprocess.run(
-                    [sys.executable, "-m", "pip", "install", "-r", str(requirements_path)],
-                    check=True
+                    [sys.executable, "-m", "pip", "install", "--quiet", "--no-input",
+                     "--disable-pip-version-check", "-r", str(requirements_path)],
+                    check=True,
+                    stderr=subprocess.PIPE,
+                    text=True
                 )
+                self._mark_deps_ok("requirements-vis.txt", requirements_path)
                 self.logger.info("依赖安装完成")
                 return True
             except subprocess.CalledProcessError as e:
-                self.logger.error(f"依赖安装失败: {e}")
+                self.logger.error(f"依赖安装失败: {e}\n{e.stderr}")
                 return False
         else:
             self.logger.error(f"未找到requirements文件: {requirements_path}")
@@ -109,6 +142,23 @@ class WSIViewer:
             self.logger.error(f"npm检查失败: {e}")
             return False
 
+    def wait_backend_ready(self) -> bool:
+        """轮询后端端口，直到可以建立连接或超时"""
+        # 监听所有地址时通过本机回环地址探测
+        host = {"0.0.0.0": "127.0.0.1", "::": "::1", "": "127.0.0.1"}.get(self.host, self.host)
+        deadline = time.monotonic() + BACKEND_READY_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.backend_process.poll() is not None:
+                self.logger.error("后端进程已退出")
+                return False
+            try:
+                socket.create_connection((host, self.backend_port), timeout=0.1).close()
+                return True
+            except OSError:
+                time.sleep(BACKEND_READY_INTERVAL)
+        self.logger.error(f"等待后端服务超时（{BACKEND_READY_TIMEOUT}秒）")
+        return False
+
     def start_backend(self) -> bool:
         """启动FastAPI后端服务"""
         self.logger.info("启动后端服务...")
@@ -134,7 +184,8 @@ class WSIViewer:
                 cwd=str(self.project_root),
                 env=env
             )
-            time.sleep(2)  # 等待服务启动
+            if not self.wait_backend_ready():  # 等待服务启动
+                return False
             self.logger.info("后端服务启动完成")
             return True
         except Exception as e:
@@ -160,21 +211,33 @@ class WSIViewer:
 
     def install_frontend_deps(self) -> bool:
         """安装前端依赖"""
-        self.logger.info("安装前端依赖...")
         if not self.frontend_dir.exists():
             self.logger.error(f"未找到前端目录: {self.frontend_dir}")
             return False
-        
+
+        # node_modules 已存在且 package-lock.json 未修改时跳过安装
+        lock_path = self.frontend_dir / "package-lock.json"
+        if (self.frontend_dir / "node_modules").exists() and (
+                not lock_path.exists()
+                or self._deps_up_to_date("package-lock.json", lock_path)):
+            self.logger.info("前端依赖已是最新，跳过安装")
+            return True
+
+        self.logger.info("安装前端依赖...")
         try:
             subprocess.run(
-                [self.npm_path, "install"],
+                [self.npm_path, "install", "--prefer-offline", "--no-audit", "--no-fund"],
                 check=True,
-                cwd=str(self.frontend_dir)
+                cwd=str(self.frontend_dir),
+                stderr=subprocess.PIPE,
+                text=True
             )
+            if lock_path.exists():
+                self._mark_deps_ok("package-lock.json", lock_path)
             self.logger.info("前端依赖安装完成")
             return True
         except subprocess.CalledProcessError as e:
-            self.logger.error(f"前端依赖安装失败: {e}")
+            self.logger.error(f"前端依赖安装失败: {e}\n{e.stderr}")
             return False
 
     def setup(self) -> bool:
@@ -192,9 +255,8 @@ class WSIViewer:
         self.npm_path = npm_path
             
         # 检查并安装前端依赖
-        if not (self.frontend_dir / "node_modules").exists():
-            if not self.install_frontend_deps():
-                return False
+        if not self.install_frontend_deps():
+            return False
 
         # 创建必要的目录
         self.static_dir.mkdir(exist_ok=True)
@@ -211,6 +273,7 @@ class WSIViewer:
         
         if not self.start_backend():
             self.logger.error("后端服务启动失败")
+            self.stop()
             return
             
         if not self.start_frontend():